@@ -1,16 +1,28 @@
 """Listen to Firestore and launch kingdom scans when jobs appear."""
 
+import functools
+import itertools
+import logging
+import os
+import queue
+import signal
 import time
 import threading
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from logging.handlers import QueueHandler, QueueListener
+
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 
-from roktracker.kingdom.governor_printer import print_gov_state
-from roktracker.kingdom.scanner import KingdomScanner
-from roktracker.utils.general import load_config
+from dummy_root import get_app_root
+from roktracker.kingdom.scan_overrides import ScanOverrides
 from roktracker.utils.output_formats import OutputFormats
 
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 
 # 1. Update this with the path to the JSON file you downloaded.
@@ -19,8 +31,21 @@ SERVICE_ACCOUNT_KEY_PATH = "serviceAccountKey.json"
 # 2. Update this with your User ID from the Firebase Authentication console.
 USER_ID = "YOUR_USER_ID_HERE"
 
+# 3. Number of scans that may run at the same time. Every scan needs its own
+#    emulator, so only raise this if the jobs use different adb ports.
+MAX_PARALLEL_SCANS = int(os.getenv("ROK_MAX_SCANS", "1"))
+
 # --- Bot Logic ---
 
+# Minimum time in seconds between two progress updates of a running scan.
+PROGRESS_INTERVAL = 2.0
+
+# Seconds to wait before claiming a job again after the claim failed.
+CLAIM_RETRY_DELAY = 5.0
+
+# Firestore allows at most 500 operations in one write batch.
+MAX_BATCH_WRITES = 500
+
 
 DEFAULT_SCAN_OPTIONS_FULL = {
     "ID": True,
@@ -41,7 +66,7 @@ DEFAULT_SCAN_OPTIONS_FULL = {
 }
 
 DEFAULT_SCAN_OPTIONS_SEED = {
-    **{k: v for k, v in DEFAULT_SCAN_OPTIONS_FULL.items()},
+    **DEFAULT_SCAN_OPTIONS_FULL,
     "T1 Kills": False,
     "T2 Kills": False,
     "T3 Kills": False,
@@ -54,156 +79,457 @@ DEFAULT_SCAN_OPTIONS_SEED = {
     "Helps": False,
 }
 
+_SCAN_OPTION_KEYS = frozenset(DEFAULT_SCAN_OPTIONS_FULL)
+
+
+# (name, job field, config path, cast) of every setting a job can override.
+SCAN_FIELDS = (
+    ("bluestacks_port", "adbPort", ("general", "adb_port"), int),
+    ("kingdom", "kingdom", ("scan", "kingdom_name"), lambda x: x or ""),
+    ("amount", "amount", ("scan", "people_to_scan"), lambda x: int(x or 0)),
+    ("resume", "resume", ("scan", "resume"), bool),
+    ("advanced_scroll", "advancedScroll", ("scan", "advanced_scroll"), bool),
+    ("track_inactives", "trackInactives", ("scan", "track_inactives"), bool),
+    ("validate_kills", "validateKills", ("scan", "validate_kills"), bool),
+    ("reconstruct_fails", "reconstructKills", ("scan", "reconstruct_kills"), bool),
+    ("validate_power", "validatePower", ("scan", "validate_power"), bool),
+    ("power_threshold", "powerThreshold", ("scan", "power_threshold"), int),
+    ("info_close", "infoTime", ("scan", "timings", "info_close"), float),
+    ("gov_close", "govTime", ("scan", "timings", "gov_close"), float),
+)
+
+# Settings that are passed on to KingdomScanner.start_scan.
+START_SCAN_ARGS = (
+    "kingdom",
+    "amount",
+    "resume",
+    "track_inactives",
+    "validate_kills",
+    "reconstruct_fails",
+    "validate_power",
+    "power_threshold",
+)
+
+
+def _config_value(config: dict, path: tuple[str, ...]):
+    for key in path:
+        config = config[key]
+    return config
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_config(mtime: float) -> MappingProxyType:
+    """Parse the config once per modification time of the file."""
+    # imported here, roktracker.utils.general pulls in OpenCV
+    from roktracker.utils.general import load_config
+
+    return _freeze(load_config())
+
+
+def _get_config() -> MappingProxyType:
+    """Return the shared read-only config, reloading it when the file changed."""
+    try:
+        mtime = os.path.getmtime(get_app_root() / "config.json")
+    except OSError:
+        # let load_config raise the proper ConfigError
+        mtime = 0.0
+    return _cached_config(mtime)
+
 
 def _build_scan_options(mode: str, overrides: dict | None = None) -> dict:
     """Return scan options for the given mode with optional overrides."""
     options = DEFAULT_SCAN_OPTIONS_SEED if mode == "seed" else DEFAULT_SCAN_OPTIONS_FULL
-    options = {k: v for k, v in options.items()}
-
     if overrides:
-        for key in options:
-            if key in overrides:
-                options[key] = bool(overrides[key])
-    return options
+        return options | {
+            key: bool(overrides[key]) for key in overrides.keys() & _SCAN_OPTION_KEYS
+        }
+    return options.copy()
+
+
+class _LogBatcher:
+    """Coalesce log lines and field updates into batched Firestore writes.
+
+    Log lines are added as documents to the ``logs`` subcollection of the job,
+    so a write never grows with the length of the log. A background thread
+    collects queued entries and commits them in a single write batch every
+    ``max_batch`` entries or ``max_wait`` seconds.
+    """
+
+    def __init__(self, doc_ref, max_batch: int = 20, max_wait: float = 0.5):
+        self._db = firestore.client()
+        self._doc_ref = doc_ref
+        self._logs_ref = doc_ref.collection("logs")
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        # orders log lines that share the same server timestamp
+        self._seq = itertools.count()
+        self._q: queue.Queue[tuple[str, object]] = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, msg: str) -> None:
+        self._q.put(("logs", msg))
+
+    def set(self, field: str, value) -> None:
+        self._q.put((field, value))
+
+    def write(self, fields: dict, *logs: str) -> None:
+        """Write fields and log lines right away, bypassing the queue."""
+        self._commit(fields, list(logs))
+
+    def flush(self) -> None:
+        """Stop the background thread and write everything still queued."""
+        self._stopped.set()
+        self._thread.join()
+
+        batch = []
+        while True:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        self._write(batch)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            batch = []
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch: list[tuple[str, object]]) -> None:
+        updates = {}
+        logs = []
+        for field, value in batch:
+            if field == "logs":
+                logs.append(value)
+            else:
+                # later values win, only the latest state is written
+                updates[field] = value
+
+        if not updates and not logs:
+            return
+
+        try:
+            self._commit(updates, logs)
+        except Exception as e:  # noqa: BLE001
+            logger.error(f"[BOT] Failed to write to Firestore: {e}")
+
+    def _commit(self, fields: dict, logs: list[str]) -> None:
+        # keep room for the field update in the last batch
+        size = MAX_BATCH_WRITES - 1
+        chunks = [logs[i : i + size] for i in range(0, len(logs), size)] or [[]]
+
+        for i, chunk in enumerate(chunks):
+            batch = self._db.batch()
+            for msg in chunk:
+                batch.set(
+                    self._logs_ref.document(),
+                    {
+                        "ts": firestore.SERVER_TIMESTAMP,
+                        "seq": next(self._seq),
+                        "msg": msg,
+                    },
+                )
+            if fields and i == len(chunks) - 1:
+                batch.update(self._doc_ref, fields)
+            batch.commit()
 
 
 def run_scan_bot(scan_doc_ref, scan_data) -> None:
     """Run a kingdom scan based on Firestore document settings."""
+    # The scanner loads OpenCV and tesserocr, only pay for that once a job arrives.
+    from roktracker.kingdom.scanner import KingdomScanner
 
-    print(f"Thread started for scan job: {scan_doc_ref.id}")
+    logger.info(f"Thread started for scan job: {scan_doc_ref.id}")
 
-    # Update job status
-    scan_doc_ref.update(
-        {
-            "status": "running",
-            "progress": 0,
-            "logs": firestore.ArrayUnion(["[BOT] Job received. Starting scanner..."]),
-        }
-    )
+    batcher = None
+
+    # local names for everything the callbacks touch per governor,
+    # batch_log and batch_set are bound once the batcher exists
+    monotonic = time.monotonic
+    log_info = logger.info
+    last_progress = 0
+    last_progress_time = 0.0
 
     def log_to_firestore(msg: str) -> None:
-        print(msg)
-        scan_doc_ref.update({"logs": firestore.ArrayUnion([msg])})
+        log_info(msg)
+        batch_log(msg)
 
     def state_callback(state: str) -> None:
-        log_to_firestore(f"[STATE] {state}")
+        msg = f"[STATE] {state}"
+        log_info(msg)
+        batch_log(msg)
 
     def gov_callback(_, extra) -> None:
-        progress = int(extra.current_governor / extra.target_governor * 100)
-        scan_doc_ref.update({"progress": progress})
+        nonlocal last_progress, last_progress_time
+        progress = extra.current_governor * 100 // extra.target_governor
+        now = monotonic()
+        # at most one progress write per PROGRESS_INTERVAL, the final
+        # value is written together with the terminal status
+        if (
+            progress > last_progress
+            and now - last_progress_time >= PROGRESS_INTERVAL
+        ):
+            last_progress = progress
+            last_progress_time = now
+            batch_set("progress", progress)
 
     try:
-        config = load_config()
-
-        bluestacks_port = int(
-            scan_data.get("adbPort", config["general"]["adb_port"])
-        )
-        kingdom = scan_data.get("kingdom", config["scan"]["kingdom_name"]) or ""
-        amount = int(
-            scan_data.get("amount", config["scan"]["people_to_scan"] or 0)
+        batcher = _LogBatcher(scan_doc_ref)
+        batch_log = batcher.log
+        batch_set = batcher.set
+
+        # Update job status
+        batcher.write(
+            {"status": "running", "progress": 0},
+            "[BOT] Job received. Starting scanner...",
         )
+
+        config = _get_config()
+
+        params = {
+            name: cast(scan_data.get(field, _config_value(config, path)))
+            for name, field, path, cast in SCAN_FIELDS
+        }
         mode = scan_data.get("mode", "full")
 
         scan_options = _build_scan_options(mode, scan_data.get("scanOptions"))
 
-        resume = bool(scan_data.get("resume", config["scan"]["resume"]))
-        advanced_scroll = bool(
-            scan_data.get("advancedScroll", config["scan"]["advanced_scroll"])
-        )
-        track_inactives = bool(
-            scan_data.get("trackInactives", config["scan"]["track_inactives"])
-        )
-        validate_kills = bool(
-            scan_data.get("validateKills", config["scan"]["validate_kills"])
-        )
-        reconstruct_kills = bool(
-            scan_data.get("reconstructKills", config["scan"]["reconstruct_kills"])
-        )
-        validate_power = bool(
-            scan_data.get("validatePower", config["scan"]["validate_power"])
-        )
-        power_threshold = int(
-            scan_data.get("powerThreshold", config["scan"]["power_threshold"])
-        )
-        info_close = float(
-            scan_data.get("infoTime", config["scan"]["timings"]["info_close"])
-        )
-        gov_close = float(
-            scan_data.get("govTime", config["scan"]["timings"]["gov_close"])
-        )
-
         output_formats = OutputFormats()
         if isinstance(scan_data.get("formats"), dict):
             output_formats.from_dict(scan_data["formats"])
         else:
             output_formats.from_dict(config["scan"]["formats"])
 
-        config["scan"]["timings"]["info_close"] = info_close
-        config["scan"]["timings"]["gov_close"] = gov_close
-        config["scan"]["advanced_scroll"] = advanced_scroll
+        overrides = ScanOverrides(
+            info_close=params["info_close"],
+            gov_close=params["gov_close"],
+            advanced_scroll=params["advanced_scroll"],
+        )
 
-        scanner = KingdomScanner(config, scan_options, bluestacks_port)
+        scanner = KingdomScanner(
+            config, scan_options, params["bluestacks_port"], overrides
+        )
         scanner.set_governor_callback(gov_callback)
         scanner.set_state_callback(state_callback)
         scanner.set_output_handler(log_to_firestore)
 
         scanner.start_scan(
-            kingdom,
-            amount,
-            resume,
-            track_inactives,
-            validate_kills,
-            reconstruct_kills,
-            validate_power,
-            power_threshold,
-            output_formats,
+            **{name: params[name] for name in START_SCAN_ARGS},
+            formats=output_formats,
         )
 
-        log_to_firestore("[BOT] Scan completed successfully.")
-        scan_doc_ref.update({"status": "completed", "progress": 100})
-
     except Exception as e:  # noqa: BLE001
         error_log = f"[BOT] Error: {e}"
-        log_to_firestore(error_log)
-        scan_doc_ref.update({"status": "failed"})
+        logger.error(error_log)
+        if batcher is not None:
+            batcher.flush()
+            try:
+                batcher.write({"status": "failed"}, error_log)
+            except Exception as e:  # noqa: BLE001
+                logger.error(f"[BOT] Failed to write to Firestore: {e}")
+
+    else:
+        # outside of the try body, a failed write must not mark the
+        # finished scan as failed
+        done_log = "[BOT] Scan completed successfully."
+        logger.info(done_log)
+        batcher.flush()
+        try:
+            batcher.write({"status": "completed", "progress": 100}, done_log)
+        except Exception as e:  # noqa: BLE001
+            logger.error(f"[BOT] Failed to write to Firestore: {e}")
+
+    finally:
+        if batcher is not None:
+            batcher.flush()
 
 # --- Firestore Listener ---
 
+# Jobs beyond MAX_PARALLEL_SCANS wait in the executor queue.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_PARALLEL_SCANS, thread_name_prefix="scan"
+)
+
+# Ids of jobs that are queued or running in this process.
+_inflight: set[str] = set()
+# Futures and document references of the submitted jobs, by id.
+_jobs: dict[str, tuple[Future, object]] = {}
+_inflight_lock = threading.Lock()
+_stopping = threading.Event()
+
+
+@firestore.transactional
+def _claim_scan(transaction, scan_doc_ref) -> dict | None:
+    """Move a job from pending to claimed and return its data.
+
+    Returns None if the job is gone or was taken already.
+    """
+    snapshot = scan_doc_ref.get(transaction=transaction)
+    scan_data = snapshot.to_dict() if snapshot.exists else None
+    if not scan_data or scan_data.get("status") != "pending":
+        return None
+
+    transaction.update(scan_doc_ref, {"status": "claimed"})
+    return scan_data
+
+
+def _job_done(doc_id: str) -> None:
+    with _inflight_lock:
+        _jobs.pop(doc_id, None)
+        _inflight.discard(doc_id)
+
+
+def _release_job(doc_id: str, scan_doc_ref) -> None:
+    try:
+        scan_doc_ref.update({"status": "pending"})
+        logger.info(f"Scan job {doc_id} was not started, set back to pending.")
+    except Exception as e:  # noqa: BLE001
+        logger.error(f"Failed to release scan job {doc_id}: {e}")
+
+
+def _start_scan(scan_doc_ref) -> None:
+    """Claim a pending job and queue it, retrying later if the claim fails."""
+    doc_id = scan_doc_ref.id
+    with _inflight_lock:
+        if _stopping.is_set() or doc_id in _inflight:
+            return
+        _inflight.add(doc_id)
+
+    try:
+        scan_data = _claim_scan(firestore.client().transaction(), scan_doc_ref)
+    except Exception as e:  # noqa: BLE001
+        # The job stays in the query result, so no new change will arrive
+        # for it. Try again later instead of dropping it.
+        logger.error(
+            f"Failed to claim scan job {doc_id}: {e}. "
+            f"Retrying in {CLAIM_RETRY_DELAY} seconds."
+        )
+        _job_done(doc_id)
+        retry = threading.Timer(CLAIM_RETRY_DELAY, _start_scan, (scan_doc_ref,))
+        retry.daemon = True
+        retry.start()
+        return
+
+    if scan_data is None:
+        _job_done(doc_id)
+        return
+
+    with _inflight_lock:
+        future = None
+        if not _stopping.is_set():
+            future = EXECUTOR.submit(run_scan_bot, scan_doc_ref, scan_data)
+            _jobs[doc_id] = (future, scan_doc_ref)
+
+    if future is None:
+        # shutdown started while the job was being claimed
+        _release_job(doc_id, scan_doc_ref)
+        _job_done(doc_id)
+        return
+
+    logger.info(f"New pending scan job found: {doc_id}")
+    future.add_done_callback(lambda _: _job_done(doc_id))
+
+
+def _release_queued_jobs() -> None:
+    """Cancel jobs that haven't started yet and set them back to pending."""
+    with _inflight_lock:
+        _stopping.set()
+        jobs = list(_jobs.items())
+
+    for doc_id, (future, scan_doc_ref) in jobs:
+        if future.cancel():
+            _release_job(doc_id, scan_doc_ref)
+
 
 def on_snapshot(doc_snapshot, changes, read_time):
-    """Called whenever there's a change in the collection."""
+    """Called whenever a pending job is added to or leaves the query."""
     for change in changes:
-        if change.type.name == 'ADDED':
-            scan_doc = change.document
-            scan_data = scan_doc.to_dict()
-
-            if scan_data.get('status') == 'pending':
-                print(f"New pending scan job found: {scan_doc.id}")
-                bot_thread = threading.Thread(
-                    target=run_scan_bot,
-                    args=(scan_doc.reference, scan_data)
-                )
-                bot_thread.start()
+        if change.type.name != 'ADDED':
+            continue
+
+        scan_doc = change.document
+        # the query only delivers pending jobs, but a change may still carry a
+        # cached snapshot from before the job was claimed elsewhere
+        if scan_doc.get('status') != 'pending':
+            continue
+
+        _start_scan(scan_doc.reference)
+
+
+def setup_logging() -> QueueListener:
+    """Send log records through a queue so scan threads never block on output."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s %(threadName)s %(levelname)s %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+    )
+
+    log_queue: queue.Queue[logging.LogRecord] = queue.Queue()
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
 
 
 def main():
     """Initialize Firebase and start the listener."""
+    log_listener = setup_logging()
+
     cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
     firebase_admin.initialize_app(cred)
     db = firestore.client()
 
     scans_ref = db.collection(u'users').document(USER_ID).collection(u'scans')
-    query_watch = scans_ref.on_snapshot(on_snapshot)
+    # Only pending jobs are sent to us, claimed jobs leave the query again.
+    pending_query = scans_ref.where(filter=FieldFilter("status", "==", "pending"))
+    query_watch = pending_query.on_snapshot(on_snapshot)
+
+    logger.info(f"Bot is running. Listening for new scan jobs for user: {USER_ID}")
+    logger.info("Create a new scan from the web app to test.")
 
-    print(f"Bot is running. Listening for new scan jobs for user: {USER_ID}")
-    print("Create a new scan from the web app to test.")
+    stop = threading.Event()
+
+    def request_stop(signum, _frame) -> None:
+        # a second signal kills the process while running scans are awaited
+        signal.signal(signum, signal.SIG_DFL)
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Waiting on a lock can't be interrupted by Ctrl+C on Windows, so wake up
+    # regularly there to let the signal handler run.
+    wait_timeout = 1.0 if os.name == "nt" else None
 
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("Shutting down bot listener.")
+        while not stop.wait(wait_timeout):
+            pass
+    finally:
+        logger.info("Shutting down bot listener.")
         query_watch.unsubscribe()
+        _release_queued_jobs()
+        logger.info("Waiting for running scans, press Ctrl+C again to quit now.")
+        EXECUTOR.shutdown(wait=True)
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ScanOverrides:
+    info_close: float
+    gov_close: float
+    advanced_scroll: bool
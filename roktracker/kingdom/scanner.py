@@ -15,6 +15,7 @@ from roktracker.utils.general import *
 from roktracker.utils.ocr import *
 from roktracker.kingdom.additional_data import AdditionalData
 from roktracker.kingdom.governor_data import GovernorData
+from roktracker.kingdom.scan_overrides import ScanOverrides
 from tesserocr import PyTessBaseAPI, PSM, OEM  # type: ignore (tesserocr has no type defs)
 from typing import Callable
 from PIL import Image
@@ -40,7 +41,9 @@ def default_output_handler(msg: str) -> None:
 
 
 class KingdomScanner:
-    def __init__(self, config, scan_options, port):
+    def __init__(
+        self, config, scan_options, port, overrides: ScanOverrides | None = None
+    ):
         self.run_id = generate_random_id(8)
         self.scan_times = []
         self.start_date = datetime.date.today()
@@ -51,6 +54,13 @@ class KingdomScanner:
         self.max_random_delay = config["scan"]["timings"]["max_random"]
 
         self.advanced_scroll = config["scan"]["advanced_scroll"]
+        if overrides is not None:
+            self.timings = {
+                **self.timings,
+                "info_close": overrides.info_close,
+                "gov_close": overrides.gov_close,
+            }
+            self.advanced_scroll = overrides.advanced_scroll
         self.scan_options = scan_options
         self.abort = False
         self.inactive_players = 0